@@ -8,13 +8,21 @@ Bernardo, Sean Benedict G.
 """
 
 # Custom imports
-import tftp_files, tftp_misc, tftp_packets
+import tftp_files, tftp_misc, tftp_packets, tftp_pacer, tftp_mirrors
 
 # Python imports
-import socket, sys, random, time
+import socket, selectors, sys, random, time
 
 # IP, PORT = "127.0.0.1", 69
 
+# Longest an ACK is held back to pace a download, kept below the 1 second
+# retransmission time-out of most servers so they do not resend every block
+ACK_HOLD_LIMIT = 0.5
+
+# How far ahead of the last block seen a multicast DATA may be and still
+# count as the stream moving forward, rather than jumping to another gap
+MULTICAST_WINDOW = 1024
+
 
 class Client:
     def __init__(self, destIP: str = None):
@@ -35,6 +43,14 @@ class Client:
         # bind client socket to start sending packets
         self.setSocket()
 
+        # per-transfer bandwidth cap in bytes per second, 0 if unlimited
+        self.rateLimit = 0
+
+        # mirrors of the destination server, downloads are hedged across
+        # the destination and its mirrors when any are set
+        self.mirrors = []
+        self.mirrorStats = tftp_mirrors.MirrorStats()
+
         # client loop
         self.loop()
 
@@ -48,6 +64,10 @@ class Client:
 
         def opDownload() -> None:
             # Download File
+
+            # the mirror that answers first is the destination for this download only
+            destIP = self.destIP
+
             try:
                 # standard block size
                 blksize = 512
@@ -58,18 +78,33 @@ class Client:
                 # append options
                 options = tftp_packets.appendOptions("RRQ")
 
-                self.sendRequest("RRQ", filename, options)
-
                 ackInit = None
 
-                # await OACK, skip if no options because
-                # regular unoptioned TFTP will immediately send DATA
-                if len(options) > 0:
-                    ackInit = self.awaitAck()
+                self.drainSocket()
+
+                if len(self.mirrors) > 0:
+                    ackInit = self.hedgeRequest(filename, options)
 
                     if ackInit == None:
+                        print(f"{filename} cannot be retrieved\n")
                         return
 
+                    self.destIP = ackInit["server"]
+                    print(f"Retrieving from {self.destIP}")
+                else:
+                    self.sendRequest("RRQ", filename, options)
+
+                    # await OACK, skip if no options because
+                    # regular unoptioned TFTP will immediately send DATA
+                    if len(options) > 0:
+                        ackInit = self.awaitAck()
+
+                        if ackInit == None:
+                            return
+
+                # A mirror may ignore every option and answer with DATA right away,
+                # which is left for receiveFile
+                if ackInit != None:
                     if ackInit["opcode"] == 5:
                         tftp_packets.printError(ackInit)
                         print("File cannot be retrieved")
@@ -82,6 +117,26 @@ class Client:
                         if "tsize" in ackInit["options"]:
                             print(f"Incoming file size: {ackInit["options"]["tsize"]}")
 
+                        # See RFC 2090, only the master client ACKs the OACK
+                        # so the multicast receiver takes care of it
+                        if "multicast" in ackInit["options"]:
+                            group = tftp_packets.parseMulticast(
+                                ackInit["options"]["multicast"]
+                            )
+                            fileData = self.receiveMulticast(
+                                blksize,
+                                ackInit["transferPort"],
+                                group,
+                                ackInit["options"].get("tsize"),
+                            )
+
+                            if fileData != None:
+                                tftp_files.writeFile(filename, fileData)
+                                print(f"{filename} was retrieved successfully\n")
+                            else:
+                                print(f"{filename} cannot be retrieved\n")
+                            return
+
                         # Send ACK for OACK
                         self.sendAck(0, ackInit["transferPort"])
 
@@ -97,6 +152,8 @@ class Client:
             except Exception:
                 # file cannot be retrieved
                 pass
+            finally:
+                self.destIP = destIP
 
         def opUpload() -> None:
 
@@ -123,6 +180,7 @@ class Client:
                 options = tftp_packets.appendOptions("WRQ")
 
                 # send request
+                self.drainSocket()
                 self.sendRequest("WRQ", filenameServer, options)
                 # await request
                 ackInit = self.awaitAck()
@@ -164,16 +222,68 @@ class Client:
 
             self.destIP = self.setDestination()
 
+        def opSetRate() -> None:
+            """Sets per-transfer and global bandwidth caps"""
+            while True:
+                rate = tftp_misc.getInput(
+                    "Enter per-transfer limit in bytes per second [0 for unlimited]: "
+                )
+                if rate.isdigit():
+                    self.rateLimit = int(rate)
+                    break
+
+            while True:
+                rate = tftp_misc.getInput(
+                    "Enter global limit in bytes per second [0 for unlimited]: "
+                )
+                if rate.isdigit():
+                    tftp_pacer.setGlobalRate(int(rate))
+                    break
+
+        def opSetMirrors() -> None:
+            """Sets mirrors of the destination server to hedge downloads across"""
+            while True:
+                mirrors = tftp_misc.getInput(
+                    "Enter mirror IP addresses separated by commas [Enter to clear]: "
+                )
+                mirrors = [mirror.strip() for mirror in mirrors.split(",")]
+                mirrors = [mirror for mirror in mirrors if mirror != ""]
+
+                if all(tftp_misc.isValidIP(mirror) for mirror in mirrors):
+                    self.mirrors = mirrors
+                    break
+
+                print("Invalid IP")
+
+            if len(self.mirrors) > 0:
+                print("Mirror ranking:")
+                print(self.mirrorStats.report(self.getMirrors()) + "\n")
+
         while True:
+            rateLimits = [self.rateLimit, tftp_pacer.globalBucket.rate]
+            rateLimits = [
+                tftp_pacer.formatRate(rate) if rate > 0 else "Unlimited"
+                for rate in rateLimits
+            ]
+
             print("=============== TFTPv2 Client ===============")
             print(
                 f"Client IP Addr:       {socket.gethostbyname(socket.gethostname())}:{self.clientPort}\n"
                 + f"Destination IP Addr.: {self.destIP}\n"
+                + f"Bandwidth Limit:      {rateLimits[0]} per transfer, {rateLimits[1]} global\n"
+                + f"Mirrors:              {", ".join(self.mirrors) if len(self.mirrors) > 0 else "None"}\n"
             )
             userInput = int(
                 tftp_misc.getInput(
                     f"What would you like to do",
-                    ["Download File", "Upload File", "Change TFTP Server IP", "Exit"],
+                    [
+                        "Download File",
+                        "Upload File",
+                        "Change TFTP Server IP",
+                        "Set Bandwidth Limit",
+                        "Set Mirror Servers",
+                        "Exit",
+                    ],
                 )
             )
 
@@ -185,6 +295,10 @@ class Client:
                 case 2:
                     opChangeDest()
                 case 3:
+                    opSetRate()
+                case 4:
+                    opSetMirrors()
+                case 5:
                     print("\nExiting...\n")
                     return
 
@@ -198,18 +312,10 @@ class Client:
             if localIP == "localhost":
                 return "127.0.0.1"
 
-            octets = localIP.split(".")
-
-            # check if there is a valid number of octets
-            if len(localIP.split(".")) != 4:
+            if not tftp_misc.isValidIP(localIP):
                 print("Invalid IP")
                 continue
 
-            # check each octet if correct
-            for octet in octets:
-                if not octet.isdigit() or int(octet) < 0 or int(octet) > 255:
-                    print("Invalid IP")
-                    continue
             return localIP
 
     def setOpenPort(self):
@@ -233,8 +339,8 @@ class Client:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
         self.sock.bind(("", self.clientPort))
 
-    def sendRequest(self, mode, filename, options={}):
-        """Sends RRQ or WRQ to server"""
+    def sendRequest(self, mode, filename, options={}, destIP=None):
+        """Sends RRQ or WRQ to server, or to a mirror if destIP is given"""
 
         if mode not in ["RRQ", "WRQ"]:
             # if this is somehow thrown, im an idiot
@@ -256,7 +362,149 @@ class Client:
                 + b"\x00"
             )
 
-        self.sock.sendto(packet, (self.destIP, self.destReqPort))
+        self.sock.sendto(
+            packet, (self.destIP if destIP == None else destIP, self.destReqPort)
+        )
+
+    def getMirrors(self) -> list[str]:
+        """Destination server followed by its mirrors, without duplicates"""
+        return list(dict.fromkeys([self.destIP] + self.mirrors))
+
+    def hedgeRequest(self, filename: str, options: dict) -> dict | None:
+        """
+        Sends an RRQ to the best-ranked mirror, and to the next one each time
+        the current one takes longer than its hedge delay to answer
+        Returns the first answer with the mirror it came from, answers from the
+        other mirrors are turned away with ERROR 5 as unknown TIDs
+        """
+        mirrors = self.mirrorStats.rank(self.getMirrors())
+
+        # mirror -> time the RRQ was sent
+        sentTimes = {}
+        # mirrors that answered with an ERROR
+        erred = []
+        lastError = None
+
+        nextHedge = time.monotonic()
+
+        while True:
+            now = time.monotonic()
+
+            if now >= nextHedge and len(sentTimes) < len(mirrors):
+                mirror = mirrors[len(sentTimes)]
+
+                if len(sentTimes) > 0:
+                    print(f"Also requesting from {mirror}")
+
+                self.sendRequest("RRQ", filename, options, mirror)
+                sentTimes[mirror] = now
+                nextHedge = now + self.mirrorStats.hedgeDelay(mirror)
+
+            # every mirror erred
+            if len(erred) == len(mirrors):
+                tftp_packets.printError(lastError)
+                return None
+
+            # give the last mirror asked as long as awaitAck would
+            deadline = max(sentTimes.values()) + 5
+
+            if now >= deadline:
+                for mirror in sentTimes:
+                    if mirror not in erred:
+                        self.mirrorStats.recordFailure(mirror, now - sentTimes[mirror])
+
+                if lastError != None:
+                    tftp_packets.printError(lastError)
+                else:
+                    print("Server connection lost, ensure TFTP server is active")
+                return None
+
+            if len(sentTimes) < len(mirrors):
+                deadline = min(deadline, nextHedge)
+
+            try:
+                self.sock.settimeout(max(deadline - now, 0.001))
+
+                # Peek so a DATA packet from the winner is left for receiveFile
+                data, server = self.sock.recvfrom(65536, socket.MSG_PEEK)
+            except socket.timeout:
+                continue
+            except ConnectionResetError:
+                # a mirror is unreachable, move on to the next one right away
+                nextHedge = now
+                continue
+
+            packet = tftp_packets.parseData(data)
+            mirror = server[0]
+
+            if mirror not in sentTimes or mirror in erred:
+                # packets from anywhere else are discarded, and their
+                # transfer cancelled as in receiveFile
+                self.sock.recvfrom(65536)
+
+                if packet["opcode"] != 5:
+                    self.sendError(server[1], 5, mirror)
+                continue
+
+            if packet["opcode"] != 3:
+                self.sock.recvfrom(65536)
+
+            self.mirrorStats.record(mirror, time.monotonic() - sentTimes[mirror])
+
+            if packet["opcode"] == 5:
+                # this mirror may not have the file, but another one might
+                erred.append(mirror)
+                lastError = packet
+                nextHedge = now
+                continue
+
+            # Mirrors that are still silent took at least this long, it only
+            # counts as a failure if they were given their full hedge delay
+            for other in sentTimes:
+                if other == mirror or other in erred:
+                    continue
+
+                waited = time.monotonic() - sentTimes[other]
+
+                if waited >= self.mirrorStats.hedgeDelay(other):
+                    self.mirrorStats.recordFailure(other, waited)
+                else:
+                    self.mirrorStats.recordLowerBound(other, waited)
+
+            # Cancel losers that answered already, a DATA answer is still
+            # queued so anything behind it is left for receiveFile to turn away
+            if packet["opcode"] != 3:
+                self.drainSocket(server)
+
+            packet["transferPort"] = server[1]
+            packet["server"] = mirror
+
+            return packet
+
+    def drainSocket(self, keep: tuple = None) -> None:
+        """
+        Turns away packets left over from earlier transfers, e.g. a late OACK
+        from a mirror that lost a race, so they are not taken as the answer to
+        the next request. Packets from keep are discarded without an error
+        """
+        self.sock.setblocking(False)
+
+        try:
+            while True:
+                try:
+                    data, source = self.sock.recvfrom(65536)
+                except ConnectionResetError:
+                    continue
+
+                # ERRORs already ended the transfer on the other end
+                if source == keep or data[:2] == b"\x00\x05":
+                    continue
+
+                self.sendError(source[1], 5, source[0])
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.setblocking(True)
 
     def awaitAck(self) -> dict | None:
         try:
@@ -276,21 +524,17 @@ class Client:
 
     def sendAck(self, blockNumber: int, transferPort: int):
         """Sends an acknowledgment to the server"""
-        packet = b"\x00\x04" + blockNumber.to_bytes(2)
+        packet = tftp_packets.makeAck(blockNumber)
         self.sock.sendto(packet, (self.destIP, transferPort))
 
-    def sendError(self, transferPort: int, errcode: int = 0):
+    def sendError(self, transferPort: int, errcode: int = 0, destIP: str = None):
         """Send error to server with unidentified transfer ID"""
 
-        packet = (
-            b"\x00\x05"
-            + errcode.to_bytes(2)
-            + tftp_packets.ERRORCODES[errcode]
-            + b"\x00"
-        )
+        packet = tftp_packets.makeError(errcode)
 
-        self.sock.sendto(packet, (self.destIP, transferPort))
-        pass
+        self.sock.sendto(
+            packet, (self.destIP if destIP == None else destIP, transferPort)
+        )
 
     def receiveFile(
         self, blksize: int, initialTransferPort: int = None
@@ -304,6 +548,18 @@ class Client:
         # keep track of timeouts
         numTimeouts = 0
 
+        pacer = tftp_pacer.Pacer(self.rateLimit)
+
+        # ACKs are held at most ACK_HOLD_LIMIT, so large blocks
+        # on a slow limit go faster than the limit
+        targetRate = pacer.targetRate()
+        if targetRate > 0 and blksize + 4 > targetRate * ACK_HOLD_LIMIT:
+            print(
+                f"Bandwidth limit is too low for a block size of {blksize}, "
+                + f"use a block size of at most {max(8, int(targetRate * ACK_HOLD_LIMIT) - 4)}"
+                + " to keep to the limit"
+            )
+
         # this variable becomes true when the last packet comes in
         # while there are potentially other packets still being sent
         checkOrder = False
@@ -321,7 +577,7 @@ class Client:
                     # Set initial transfer port if first
                     # DATA is first response from server
                     initialTransferPort = server[1]
-                elif transferPort != initialTransferPort:
+                elif transferPort != initialTransferPort or server[0] != self.destIP:
                     # "If a source TID does not match,
                     # the packet should be discarded as
                     # erroneously sent from somewhere else."
@@ -330,7 +586,8 @@ class Client:
 
                     # An error packet should be sent to the
                     # source of the incorrect packet...
-                    self.sendError(transferPort, 5)
+                    # (e.g. a mirror that lost the race, this cancels its transfer)
+                    self.sendError(transferPort, 5, server[0])
                     # while not disturbing the transfer
                     continue
 
@@ -348,6 +605,10 @@ class Client:
                         # There are occasions that a packet with 0 bytes of data will be added
                         # This is fine 🔥🔥🔥
                         uniquePackets.append(data)
+
+                        # Pace downloads by holding back the ACK, but not
+                        # long enough for the server to resend the block
+                        pacer.wait(len(data["data"]) + 4, ACK_HOLD_LIMIT)
                         self.sendAck(data["block"], transferPort)
 
                         # reset number of timeouts
@@ -365,6 +626,9 @@ class Client:
                     else:
                         # Tell user that duplicate data is found
                         print(f"Duplicate DATA found; Block Num: {data["block"]}")
+
+                        # duplicates still used up bandwidth
+                        pacer.count(len(data["data"]) + 4)
                 elif data["opcode"] == 5:
                     tftp_packets.printError(data)
                     return None
@@ -387,6 +651,8 @@ class Client:
         if len(uniquePackets) == 0:
             return None
 
+        print(pacer.report())
+
         # Sort data by block sequence number
         uniquePackets.sort(key=lambda data: data["block"])
 
@@ -395,6 +661,190 @@ class Client:
 
         return fileData
 
+    def receiveMulticast(
+        self, blksize: int, transferPort: int, group: dict, tsize: int = None
+    ) -> bytes | None:
+        """
+        Receives a file from a multicast group as per RFC 2090
+        DATA arrives on the group while OACKs and ERRORs arrive on the unicast socket
+        """
+        if group["addr"] == None or group["port"] == None:
+            print("Server did not provide a multicast group")
+            return None
+
+        isMaster = group["master"]
+        print(
+            f"Joining multicast group {group["addr"]}:{group["port"]}"
+            + (" as master client" if isMaster else "")
+        )
+
+        # Several clients on the same host may listen on the same group port
+        mcastSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        mcastSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        mcastSock.bind(("", group["port"]))
+
+        # Join the group on the interface facing the server, loopback
+        # has no default multicast route so it has to be named explicitly
+        interface = "127.0.0.1" if self.destIP.startswith("127.") else "0.0.0.0"
+        membership = socket.inet_aton(group["addr"]) + socket.inet_aton(interface)
+        mcastSock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(mcastSock, selectors.EVENT_READ)
+
+        # blocks received so far, keyed by block number, block numbers here
+        # are not wrapped to 16 bits so images over 65535 blocks work
+        blocks = {}
+        # highest block number such that every block before it was received
+        contiguous = 0
+        # block number of the short block which ends the file
+        lastBlock = None
+
+        # With the file size known, a wrapped block number can often
+        # be matched to exactly one block of the file
+        numBlocks = tsize // blksize + 1 if tsize != None else None
+
+        # block number of the last DATA seen on the group, None while unknown
+        streamPos = None
+
+        numTimeouts = 0
+
+        def locateBlock(wrapped: int) -> int | None:
+            """Maps a 16-bit block number to its block of the file, None if ambiguous"""
+            if streamPos != None:
+                # the stream moves forward one block at a time, or
+                # repeats the last block on a retransmission
+                step = (wrapped - streamPos) % 65536
+                if step <= MULTICAST_WINDOW:
+                    return streamPos + step
+                if step == 65535:
+                    return streamPos - 1
+
+            # The stream jumped back for another master client's gaps
+            if numBlocks == None:
+                return wrapped if wrapped != 0 else None
+
+            candidates = range(wrapped, numBlocks + 1, 65536)
+            candidates = [block for block in candidates if block >= 1]
+
+            return candidates[0] if len(candidates) == 1 else None
+
+        def sendMasterAck(resume: bool = False) -> None:
+            """
+            The master client ACKs the block before its first missing block,
+            so the server resumes from the gap
+            """
+            nonlocal streamPos
+
+            if resume or streamPos == None:
+                # The server reads the first ACK of a new master client
+                # as a block of the first 65536, resending a few more
+                # blocks than needed is harmless
+                block = min(contiguous, 65535)
+            else:
+                # Any other ACK is read as the block closest to the last one
+                # the server sent, so stay within half the block number range
+                block = min(max(contiguous, streamPos - 32767), streamPos + 32767)
+
+            self.sendAck(block, transferPort)
+
+            # the server sends the next block from here
+            streamPos = block
+
+        if isMaster:
+            sendMasterAck(True)
+
+        try:
+            # The master client also waits until its ACKs have
+            # stepped all the way up to the final block
+            while (
+                lastBlock == None
+                or contiguous < lastBlock
+                or (isMaster and streamPos != lastBlock)
+            ):
+                events = selector.select(timeout=5)
+
+                if len(events) == 0:
+                    if numTimeouts >= 5:
+                        print("Server connection lost, ensure TFTP server is active")
+                        return None
+
+                    numTimeouts += 1
+
+                    # Only the master client may ask the server to resume
+                    if isMaster:
+                        sendMasterAck()
+                    continue
+
+                for key, _ in events:
+                    data, server = key.fileobj.recvfrom(blksize + 4)
+
+                    if server[1] != transferPort or server[0] != self.destIP:
+                        # Stray packet from another TID, see receiveFile
+                        if key.fileobj == self.sock:
+                            self.sendError(server[1], 5, server[0])
+                        continue
+
+                    data = tftp_packets.parseData(data)
+
+                    match data["opcode"]:
+                        case 3:
+                            numTimeouts = 0
+
+                            block = locateBlock(data["block"])
+
+                            # skip blocks that cannot be placed until the stream
+                            # reaches one that can, the master client already
+                            # knows where the stream is from its own ACKs
+                            if block == None:
+                                if not isMaster:
+                                    streamPos = None
+                                continue
+
+                            streamPos = block
+
+                            if block not in blocks:
+                                blocks[block] = data["data"]
+
+                            if len(data["data"]) < blksize:
+                                lastBlock = block
+
+                            while contiguous + 1 in blocks:
+                                contiguous += 1
+
+                            if isMaster:
+                                sendMasterAck()
+                        case 5:
+                            tftp_packets.printError(data)
+                            return None
+                        case 6:
+                            # Server changed who the master client is
+                            if "multicast" in data["options"]:
+                                wasMaster = isMaster
+                                isMaster = tftp_packets.parseMulticast(
+                                    data["options"]["multicast"]
+                                )["master"]
+
+                                if isMaster and not wasMaster:
+                                    print(
+                                        f"Became master client, {len(blocks)} blocks received"
+                                    )
+                                    sendMasterAck(True)
+
+            # A non-master client tells the server it is done so it
+            # is not promoted to master later on
+            if not isMaster:
+                self.sendAck(lastBlock, transferPort)
+        except ConnectionResetError:
+            print("Server connection lost, ensure TFTP server is active")
+            return None
+        finally:
+            selector.close()
+            mcastSock.close()
+
+        return b"".join(blocks[block] for block in range(1, lastBlock + 1))
+
     # Note to self: figure out why tf there's a seperate
     # ACK packet being received regardless of optioned or not optioned
     def sendFile(
@@ -407,11 +857,25 @@ class Client:
 
         sentBlocks = []
 
+        # keep track of timeouts
+        numTimeouts = 0
+
+        # last block sent, kept for retransmission
+        lastSent = None
+
+        pacer = tftp_pacer.Pacer(self.rateLimit)
+
         def sendBlock(blockNumber: int, data: bytes, transferPort: int) -> None:
             """Sends a block to the server"""
+            nonlocal lastSent
             try:
                 packet = b"\x00\x03" + blockNumber.to_bytes(2) + data
+
+                # wait for the token bucket instead of flooding the server
+                pacer.wait(len(packet))
                 self.sock.sendto(packet, (self.destIP, transferPort))
+
+                lastSent = (blockNumber, data, transferPort)
             except Exception as e:
                 raise e
 
@@ -465,6 +929,7 @@ class Client:
 
                         # Add block number to list of sent blocks
                         sentBlocks.append(data["block"])
+                        numTimeouts = 0
 
                         nextBlock = data["block"] + 1
 
@@ -477,6 +942,7 @@ class Client:
                             # If the last block is exactly transferSize bytes, or transferSize, send an empty block to signal the end of the file
                             sendBlock(nextBlock, b"", transferPort)
                         else:
+                            print(pacer.report())
                             print("File sent successfully!\n")
                             return
                     case 5:
@@ -488,9 +954,9 @@ class Client:
                 break
             except socket.timeout:
                 # Retransmit block if no ACK is received, otherwise break
-                if data and data["opcode"] != 4 or numTimeouts < 5:
-                    print(f"TIMEOUT: Resending block {data["block"] + 1}")
-                    sendBlock(filecontent[data["block"] + 1], transferPort)
+                if lastSent != None and numTimeouts < 5:
+                    print(f"TIMEOUT: Resending block {lastSent[0]}")
+                    sendBlock(*lastSent)
                     numTimeouts += 1
                 else:
                     print("Timed out")
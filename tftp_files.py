@@ -1,39 +1,41 @@
 import os
 
 
-def fileExists(filename: str) -> bool:
+def fileExists(filename: str, folder: str = "client") -> bool:
     """Checks if a file exists"""
-    return os.path.exists(f"client/{filename}")
+    return os.path.exists(f"{folder}/{filename}")
 
 
-def makeFolder() -> None:
+def makeFolder(folder: str = "client") -> None:
     """Creates a directory if it does not exist"""
-    if not os.path.exists("client"):
-        print("Creating client folder...\n")
+    if not os.path.exists(folder):
+        print(f"Creating {folder} folder...\n")
         try:
-            os.makedirs("client")
+            os.makedirs(folder)
         except:
             pass
 
 
-def writeFile(filename: str, content: bytes) -> None:
+def writeFile(filename: str, content: bytes, folder: str = "client") -> None:
     """Writes content to a file"""
 
-    file = open(f"client/{filename}", "wb")
+    file = open(f"{folder}/{filename}", "wb")
     file.write(content)
     file.close()
 
 
-def readFile(filename: str, numBytes: int = -1) -> bytes | list[dict[str, bytes]]:
+def readFile(
+    filename: str, numBytes: int = -1, folder: str = "client"
+) -> bytes | list[dict[str, bytes]]:
     """
     Reads a file and returns its content as bytes
     If a numBytes is provided, a bytearray of that size for each chunk is returned
     """
     try:
-        file = open(f"client/{filename}", "rb")
+        file = open(f"{folder}/{filename}", "rb")
 
         # check if file is empty
-        if os.stat(f"client/{filename}").st_size == 0:
+        if os.stat(f"{folder}/{filename}").st_size == 0:
             return {1: b""}
 
         blockNumber = 1
@@ -0,0 +1,259 @@
+"""
+Multicast TFTP Responder
+as defined by RFC 2090
+
+A minimal read-only server used to test the multicast option of the client
+on loopback. Files are served from the server folder.
+
+Usage: python tftp_mcast_responder.py [-port PORT]
+"""
+
+# Custom imports
+import tftp_files, tftp_packets
+
+# Python imports
+import socket, select, sys, time
+
+# Multicast groups are handed out from the administratively scoped range
+GROUP_BASE, GROUP_PORT = "239.255.69.", 1758
+
+
+class Session:
+    """A single file being multicast to a group of clients"""
+
+    def __init__(self, filename: str, blksize: int, group: str, bindIP: str):
+        self.filename = filename
+        self.blksize = blksize
+        self.group = group
+
+        self.blocks = tftp_files.readFile(filename, blksize, "server")
+        self.numBlocks = len(self.blocks)
+
+        # A file that is a multiple of the block size ends with an empty block
+        if len(self.blocks[self.numBlocks]) == blksize:
+            self.numBlocks += 1
+            self.blocks[self.numBlocks] = b""
+
+        # clients in the order they joined, the master client is the first one
+        self.clients = []
+
+        # set until the master client sends its first ACK, which
+        # names a block of the first 65536 as block numbers wrap
+        self.resuming = True
+
+        # last block sent to the group, used for retransmission
+        self.lastSent = None
+        self.lastSentTime = time.monotonic()
+        self.numTimeouts = 0
+
+        # The session socket is the server TID for every client in the group
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((bindIP, 0))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(bindIP)
+        )
+
+    def master(self) -> tuple | None:
+        return self.clients[0] if len(self.clients) > 0 else None
+
+    def sendBlock(self, blockNumber: int) -> None:
+        """Sends a block to the whole group"""
+        packet = tftp_packets.makeData(blockNumber, self.blocks[blockNumber])
+        self.sock.sendto(packet, (self.group, GROUP_PORT))
+
+        self.lastSent = blockNumber
+        self.lastSentTime = time.monotonic()
+
+    def sendOack(self, client: tuple, options: dict) -> None:
+        self.sock.sendto(tftp_packets.makeOack(options), client)
+
+    def removeClient(self, client: tuple) -> None:
+        """Removes a client and promotes the next one to master if needed"""
+        wasMaster = client == self.master()
+        self.clients.remove(client)
+        self.numTimeouts = 0
+
+        if wasMaster and self.master() != None:
+            # See RFC 2090, address and port may be omitted when
+            # the server only changes the master client
+            print(f"{self.filename}: {self.master()} is now the master client")
+            self.sendOack(self.master(), {"multicast": ",,1"})
+            self.lastSentTime = time.monotonic()
+            self.resuming = True
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class MulticastResponder:
+    def __init__(self, bindIP: str = "127.0.0.1", port: int = 69):
+        self.bindIP = bindIP
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((bindIP, port))
+
+        # sessions keyed by filename and block size,
+        # clients with different block sizes cannot share a stream
+        self.sessions = {}
+        self.nextGroup = 1
+
+        print(f"Listening on {bindIP}:{port}, serving files from server/\n")
+
+        self.loop()
+
+    def __del__(self):
+        if hasattr(self, "sock"):
+            self.sock.close()
+
+    def loop(self):
+        """Main loop for the responder"""
+        while True:
+            sockets = [self.sock] + [s.sock for s in self.sessions.values()]
+            readable, _, _ = select.select(sockets, [], [], 0.25)
+
+            for sock in readable:
+                try:
+                    data, client = sock.recvfrom(65536)
+                except ConnectionResetError:
+                    continue
+
+                # a malformed packet or unreadable file must not
+                # take down the groups of every other client
+                try:
+                    if sock == self.sock:
+                        self.handleRequest(data, client)
+                    else:
+                        self.handleAck(sock, data, client)
+                except Exception as err:
+                    print(f"[{type(err).__name__}]: {err}")
+                    sock.sendto(tftp_packets.makeError(4), client)
+
+            self.checkTimeouts()
+
+    def handleRequest(self, data: bytes, client: tuple) -> None:
+        """Handles an RRQ on the request port"""
+        request = tftp_packets.parseData(data)
+
+        if request["opcode"] != 1:
+            self.sock.sendto(tftp_packets.makeError(4), client)
+            return
+
+        if "multicast" not in request["options"]:
+            self.sock.sendto(
+                tftp_packets.makeError(0, "Multicast option required"), client
+            )
+            return
+
+        filename = request["filename"]
+        if not tftp_files.fileExists(filename, "server"):
+            self.sock.sendto(tftp_packets.makeError(1), client)
+            return
+
+        blksize = request["options"].get("blksize", 512)
+
+        if (filename, blksize) not in self.sessions:
+            group = GROUP_BASE + str(self.nextGroup)
+            self.nextGroup = self.nextGroup % 254 + 1
+
+            self.sessions[(filename, blksize)] = Session(
+                filename, blksize, group, self.bindIP
+            )
+
+        session = self.sessions[(filename, blksize)]
+        session.clients.append(client)
+        isMaster = client == session.master()
+
+        print(
+            f"{filename}: {client} joined {session.group}:{GROUP_PORT}"
+            + (" as master client" if isMaster else "")
+        )
+
+        options = {"multicast": f"{session.group},{GROUP_PORT},{int(isMaster)}"}
+        if "blksize" in request["options"]:
+            options["blksize"] = blksize
+        if "tsize" in request["options"]:
+            options["tsize"] = sum(len(block) for block in session.blocks.values())
+
+        session.sendOack(client, options)
+
+    def handleAck(self, sock: socket.socket, data: bytes, client: tuple) -> None:
+        """Handles an ACK on a session socket"""
+        session = next(s for s in self.sessions.values() if s.sock == sock)
+        ack = tftp_packets.parseData(data)
+
+        if client not in session.clients:
+            # Late duplicate of a final ACK, the client is already done
+            if ack["opcode"] == 4 and ack["block"] == session.numBlocks % 65536:
+                return
+
+            sock.sendto(tftp_packets.makeError(5), client)
+            return
+
+        if ack["opcode"] == 5:
+            session.removeClient(client)
+        elif ack["opcode"] == 4:
+            # ACKs carry 16-bit block numbers. The master ACKs near the last
+            # block sent, except for its first ACK, and the others only ACK
+            # the final block
+            if client != session.master():
+                block = tftp_packets.unwrapBlock(ack["block"], session.numBlocks)
+            elif session.resuming:
+                block = ack["block"]
+                session.resuming = False
+            else:
+                block = tftp_packets.unwrapBlock(ack["block"], session.lastSent)
+
+            if block >= session.numBlocks:
+                print(f"{session.filename}: {client} finished")
+                session.removeClient(client)
+            elif client == session.master():
+                # See RFC 2090, the master client ACKs the block before
+                # its first missing block, so continue from there
+                session.numTimeouts = 0
+                session.sendBlock(block + 1)
+        else:
+            return
+
+        if len(session.clients) == 0:
+            print(f"{session.filename}: all clients done, closing session\n")
+            session.close()
+            del self.sessions[(session.filename, session.blksize)]
+
+    def checkTimeouts(self) -> None:
+        """Retransmits the last block if the master client has not ACKed it"""
+        for session in list(self.sessions.values()):
+            if time.monotonic() - session.lastSentTime < 1:
+                continue
+
+            if session.numTimeouts < 5:
+                session.numTimeouts += 1
+                session.lastSentTime = time.monotonic()
+
+                # Nothing to resend while waiting for the master's first ACK
+                if session.lastSent != None:
+                    session.sendBlock(session.lastSent)
+                continue
+
+            # Master client went away, give the next client a turn
+            print(f"{session.filename}: {session.master()} timed out")
+            session.removeClient(session.master())
+
+            if len(session.clients) == 0:
+                session.close()
+                del self.sessions[(session.filename, session.blksize)]
+
+
+if __name__ == "__main__":
+    port = 69
+
+    if len(sys.argv) > 2 and sys.argv[1] == "-port":
+        port = int(sys.argv[2])
+
+    tftp_files.makeFolder("server")
+
+    try:
+        MulticastResponder(port=port)
+    except KeyboardInterrupt:
+        print("\nExiting...\n")
@@ -0,0 +1,103 @@
+"""
+Contains per-mirror latency statistics used to rank mirror servers
+and to decide how long to wait before hedging a request to the next one
+"""
+
+# Latency assumed for mirrors that have not answered yet, in seconds
+DEFAULT_LATENCY = 0.2
+
+# Bounds of the delay before hedging to the next mirror, in seconds
+MIN_HEDGE_DELAY, MAX_HEDGE_DELAY = 0.02, 1.0
+
+# Penalty for every consecutive time a mirror did not answer, in seconds
+# (5 seconds is how long awaitAck waits before giving up)
+FAILURE_PENALTY = 5
+
+
+class MirrorStats:
+    def __init__(self):
+        # ip -> smoothed latency, latency variation, consecutive failures
+        self.stats = {}
+
+    def get(self, mirror: str) -> dict:
+        if mirror not in self.stats:
+            self.stats[mirror] = {"srtt": None, "rttvar": 0, "failures": 0}
+
+        return self.stats[mirror]
+
+    def record(self, mirror: str, latency: float) -> None:
+        """Records the time a mirror took to answer a request"""
+        stats = self.get(mirror)
+        self.smooth(stats, latency)
+
+        stats["failures"] = 0
+
+    def recordFailure(self, mirror: str, waited: float = None) -> None:
+        """
+        Records that a mirror did not answer, waited is how long it was given
+        """
+        if waited != None:
+            self.recordLowerBound(mirror, waited)
+
+        self.get(mirror)["failures"] += 1
+
+    def recordLowerBound(self, mirror: str, waited: float) -> None:
+        """
+        Records that a mirror had not answered after waited seconds
+        It took at least that long, so it counts as a sample when it is
+        above the current estimate, without clearing the failures
+        """
+        stats = self.get(mirror)
+
+        if stats["srtt"] == None or waited > stats["srtt"]:
+            self.smooth(stats, waited)
+
+    def smooth(self, stats: dict, latency: float) -> None:
+        # See RFC 6298, sec. 2 for the smoothing used by TCP
+        if stats["srtt"] == None:
+            stats["srtt"] = latency
+            stats["rttvar"] = latency / 2
+        else:
+            stats["rttvar"] = 0.75 * stats["rttvar"] + 0.25 * abs(
+                stats["srtt"] - latency
+            )
+            stats["srtt"] = 0.875 * stats["srtt"] + 0.125 * latency
+
+    def score(self, mirror: str) -> float:
+        """Expected time to answer, lower is better"""
+        stats = self.get(mirror)
+        latency = stats["srtt"] if stats["srtt"] != None else DEFAULT_LATENCY
+
+        return latency + stats["failures"] * FAILURE_PENALTY
+
+    def rank(self, mirrors: list[str]) -> list[str]:
+        """Sorts mirrors from best to worst, ties keep the configured order"""
+        return sorted(mirrors, key=self.score)
+
+    def hedgeDelay(self, mirror: str) -> float:
+        """How long to wait for a mirror before also asking the next one"""
+        stats = self.get(mirror)
+
+        if stats["srtt"] == None:
+            return DEFAULT_LATENCY
+
+        # Same as the retransmission timeout of RFC 6298, a mirror slower
+        # than this is most likely slow or dead this time around
+        delay = stats["srtt"] + 4 * stats["rttvar"]
+
+        return min(MAX_HEDGE_DELAY, max(MIN_HEDGE_DELAY, delay))
+
+    def report(self, mirrors: list[str]) -> str:
+        """Summarizes the stats of each mirror, best first"""
+        lines = []
+
+        for mirror in self.rank(mirrors):
+            stats = self.get(mirror)
+            latency = (
+                f"{stats["srtt"] * 1000:.1f} ms"
+                if stats["srtt"] != None
+                else "no answer yet"
+            )
+            lines.append(f"  {mirror}: {latency}, {stats["failures"]} failures")
+
+        return "\n".join(lines)
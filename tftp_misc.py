@@ -43,4 +43,20 @@ def getInput(prompt: str, options: list = []) -> str | int:
             return userInput
     except KeyboardInterrupt:
         # If the user presses Ctrl+C, exit the program
-        exit()
\ No newline at end of file
+        exit()
+
+
+def isValidIP(ip: str) -> bool:
+    """Checks if a string is a valid IPv4 address"""
+    octets = ip.split(".")
+
+    # check if there is a valid number of octets
+    if len(octets) != 4:
+        return False
+
+    # check each octet if correct
+    for octet in octets:
+        if not octet.isdigit() or int(octet) < 0 or int(octet) > 255:
+            return False
+
+    return True
@@ -0,0 +1,129 @@
+"""
+Contains the token bucket used to pace transfers
+
+Every transfer has its own bucket, and all transfers in the process also
+draw from a shared global bucket. A rate of 0 means unlimited.
+"""
+
+import threading, time
+
+
+class TokenBucket:
+    def __init__(self, rate: int = 0, burst: int = None):
+        # rate in bytes per second
+        self.rate = rate
+        # allow up to 100 ms worth of data to go out back to back
+        self.burst = burst if burst != None else rate // 10
+
+        self.tokens = self.burst
+        self.lastRefill = time.monotonic()
+
+        # the global bucket may be shared between threads
+        self.lock = threading.Lock()
+
+    def setRate(self, rate: int, burst: int = None) -> None:
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst != None else rate // 10
+            # debt from an earlier rate would hold up the next transfer
+            self.tokens = max(0, min(self.tokens, self.burst))
+
+    def consume(self, numBytes: int) -> float:
+        """
+        Takes numBytes worth of tokens, returns how long the caller must wait
+        The bucket may go into debt so blocks larger than the burst still pass
+        """
+        with self.lock:
+            if self.rate <= 0:
+                return 0
+
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.lastRefill) * self.rate
+            )
+            self.lastRefill = now
+
+            self.tokens -= numBytes
+
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, delay: float, waited: float) -> None:
+        """Gives back the tokens for the part of a delay that was not waited"""
+        with self.lock:
+            if self.rate > 0 and delay > waited:
+                self.tokens = min(
+                    self.burst, self.tokens + (delay - waited) * self.rate
+                )
+
+
+# Shared by every transfer in the process
+globalBucket = TokenBucket()
+
+
+def setGlobalRate(rate: int) -> None:
+    """Sets the process-wide bandwidth cap in bytes per second"""
+    globalBucket.setRate(rate)
+
+
+class Pacer:
+    """Paces a single transfer against its own cap and the global cap"""
+
+    def __init__(self, rate: int = 0):
+        self.bucket = TokenBucket(rate)
+        self.numBytes = 0
+        self.start = time.monotonic()
+
+    def count(self, numBytes: int) -> None:
+        """Records numBytes as transferred without pacing"""
+        self.numBytes += numBytes
+
+    def wait(self, numBytes: int, maxDelay: float = None) -> bool:
+        """
+        Blocks until numBytes may be sent (or ACKed) without exceeding either cap
+        Waits at most maxDelay seconds if given, returns False if the wait was cut short
+        """
+        self.count(numBytes)
+
+        delay = self.bucket.consume(numBytes)
+        globalDelay = globalBucket.consume(numBytes)
+
+        if maxDelay != None and max(delay, globalDelay) > maxDelay:
+            time.sleep(maxDelay)
+
+            # the debt not waited off would otherwise be paid by the next
+            # transfer, as the global bucket outlives this one
+            self.bucket.refund(delay, maxDelay)
+            globalBucket.refund(globalDelay, maxDelay)
+            return False
+
+        delay = max(delay, globalDelay)
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return True
+
+    def targetRate(self) -> int:
+        """Effective cap of the transfer, 0 if unlimited"""
+        rates = [rate for rate in [self.bucket.rate, globalBucket.rate] if rate > 0]
+        return min(rates) if len(rates) > 0 else 0
+
+    def report(self) -> str:
+        """Summarizes achieved rate against the target rate"""
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        achieved = self.numBytes / elapsed
+        target = self.targetRate()
+
+        summary = f"Transferred {self.numBytes} bytes in {elapsed:.2f} s ({formatRate(achieved)}"
+        if target > 0:
+            summary += f", target {formatRate(target)}, {achieved / target:.0%} of target"
+
+        return summary + ")"
+
+
+def formatRate(rate: float) -> str:
+    """Formats a rate in bytes per second"""
+    for unit in ["B/s", "KiB/s", "MiB/s"]:
+        if rate < 1024 or unit == "MiB/s":
+            return f"{rate:.1f} {unit}"
+        rate /= 1024
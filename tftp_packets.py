@@ -30,14 +30,20 @@ def printError(packet) -> None:
 def appendOptions(mode: str) -> dict:
     options = {}
 
-    while True and len(options.keys()) < 2:
+    # Multicast (RFC 2090) only applies to reads
+    choices = ["Block size", "Transfer Communication size"]
+    if mode == "RRQ":
+        choices.append("Multicast")
+    choices.append("None")
+
+    while True and len(options.keys()) < len(choices) - 1:
         tempOption = tftp_misc.getInput(
             "What options would you like to append",
-            ["Block size", "Transfer Communication size", "None"],
+            choices,
         )
 
-        match tempOption:
-            case 0:
+        match choices[tempOption]:
+            case "Block size":
                 while True:
                     try:
                         blocksize = tftp_misc.getInput("Enter block size: ")
@@ -53,7 +59,7 @@ def appendOptions(mode: str) -> dict:
                             print("Block size must be between 8 and 65464")
                     except KeyboardInterrupt:
                         break
-            case 1:
+            case "Transfer Communication size":
                 while True:
                     try:
                         # In Read Request packets, a size of "0" is specified in the request
@@ -68,12 +74,96 @@ def appendOptions(mode: str) -> dict:
                                 break
                     except KeyboardInterrupt:
                         break
-            case 2:
+            case "Multicast":
+                # See RFC 2090, the client sends an empty value and
+                # the server fills in the group address in the OACK
+                options["multicast"] = ""
+                # the file size tells which block a wrapped block number is
+                options["tsize"] = 0
+            case "None":
                 break
 
     return options
 
 
+def parseMulticast(value: str) -> dict:
+    """
+    Parses the value of a multicast option, formatted as "addr,port,mc"
+    Address and port may be left empty when the server only changes the master client
+    """
+    addr, port, master = (value.split(",") + ["", "", ""])[:3]
+
+    return {
+        "addr": addr if addr != "" else None,
+        "port": int(port) if port.isdigit() else None,
+        "master": master == "1",
+    }
+
+
+def makeData(blockNumber: int, data: bytes) -> bytes:
+    """Builds a DATA packet, block numbers wrap around past 65535"""
+    # See RFC 1350, sec. 5, figure 5-2
+    return b"\x00\x03" + (blockNumber % 65536).to_bytes(2) + data
+
+
+def makeAck(blockNumber: int) -> bytes:
+    """Builds an ACK packet, block numbers wrap around past 65535"""
+    # See RFC 1350, sec. 5, figure 5-3
+    return b"\x00\x04" + (blockNumber % 65536).to_bytes(2)
+
+
+def unwrapBlock(block: int, reference: int) -> int:
+    """
+    Maps a 16-bit block number from a packet back to the full block number
+    closest to reference, for transfers longer than 65535 blocks
+    """
+    diff = (block - reference) % 65536
+    if diff >= 32768:
+        diff -= 65536
+
+    unwrapped = reference + diff
+
+    return unwrapped if unwrapped >= 0 else unwrapped + 65536
+
+
+def makeError(errcode: int, errmessage: str = None) -> bytes:
+    """Builds an ERROR packet, defaults to the standard message of the error code"""
+    if errmessage == None:
+        errmessage = ERRORCODES[errcode] if errcode in ERRORCODES else ""
+
+    # See RFC 1350, sec. 5, figure 5-4
+    return b"\x00\x05" + errcode.to_bytes(2) + errmessage.encode("utf-8") + b"\x00"
+
+
+def makeOack(options: dict) -> bytes:
+    """Builds an OACK packet as per RFC 2347"""
+    packet = b"\x00\x06"
+
+    for key in options:
+        packet += (
+            key.encode("utf-8") + b"\x00" + str(options[key]).encode("utf-8") + b"\x00"
+        )
+
+    return packet
+
+
+def parseOptions(data: list[bytes]) -> dict:
+    """Parses alternating option names and values as per RFC 2347"""
+    options = {}
+
+    for i in range(0, len(data) - 1, 2):
+        optionType, optionData = data[i].decode("utf-8").lower(), data[i + 1].decode(
+            "utf-8"
+        )
+
+        if optionType in ["blksize", "tsize"]:
+            optionData = int(optionData)
+
+        options[optionType] = optionData
+
+    return options
+
+
 def parseData(rawdata: bytes) -> dict:
     """Parses data packet by extracting opcode and relevant data depending on opcode"""
     # got this trick from geeks for geeks
@@ -81,6 +171,17 @@ def parseData(rawdata: bytes) -> dict:
     opcode = int.from_bytes(rawdata[:2])
 
     match opcode:
+        # RRQ and WRQ
+        case 1 | 2:
+            # See RFC 1350, sec. 5, figure 5-1
+            data = rawdata[2:].split(b"\x00")[0:-1]
+
+            return {
+                "opcode": opcode,
+                "filename": data[0].decode("utf-8"),
+                "mode": data[1].decode("utf-8").lower(),
+                "options": parseOptions(data[2:]),
+            }
         # DATA
         case 3:
             block, data = int.from_bytes(rawdata[2:4]), rawdata[4:]
@@ -102,23 +203,9 @@ def parseData(rawdata: bytes) -> dict:
             }
         # OACK
         case 6:
-            data = rawdata[2:]
-
             # split data by null byte, omit last element as its empty
-            data = data.split(b"\x00")[0:-1]
-
-            options = {}
-
-            for i in range(0, len(data), 2):
-                optionType, optionData = data[i].decode("utf-8"), data[i + 1].decode(
-                    "utf-8"
-                )
-
-                if optionType in ["blksize", "tsize"]:
-                    optionData = int(optionData)
-
-                options[optionType] = optionData
+            data = rawdata[2:].split(b"\x00")[0:-1]
 
-            return {"opcode": opcode, "options": options}
+            return {"opcode": opcode, "options": parseOptions(data)}
 
     return {"opcode": opcode}
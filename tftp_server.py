@@ -0,0 +1,611 @@
+"""
+TFTPv2 Server Implementation
+as defined by RFC 1350, with options from RFCs 2347, 2348, and 2349
+
+Serves RRQ and WRQ from the server folder. All sessions are multiplexed
+on one thread with selectors (epoll on Linux), and worker processes may
+share the request port to use more cores.
+
+Usage: python tftp_server.py [-bind IP] [-port PORT] [-workers N]
+"""
+
+# Custom imports
+import tftp_files, tftp_packets, tftp_pacer
+
+# Python imports
+import socket, selectors, sys, os, time, heapq, itertools, collections, tempfile
+import multiprocessing
+
+try:
+    # Unix only, used to allow one socket per session for thousands of sessions
+    import resource
+except ImportError:
+    resource = None
+
+SERVER_FOLDER = "server"
+
+# 1 second time-out with up to five retransmissions, same as the client
+TIMEOUT, MAX_RETRIES = 1, 5
+
+# Largest block size as per RFC 2348
+MAX_BLKSIZE = 65464
+
+# Receive buffer of the request port, in bytes
+REQUEST_BUFFER = 4 * 1024 * 1024
+
+# Seconds between metric reports
+REPORT_INTERVAL = 5
+
+
+def fileVersion(stat: os.stat_result) -> tuple:
+    """Identifies a version of a file, changes when it is replaced or rewritten"""
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class FileCache:
+    """
+    LRU cache of open file handles and of fixed-size pages of file contents
+    so hot files (e.g. boot images) are served from memory
+
+    Sessions pin the version of a file they started reading, so a file
+    replaced by an upload mid-transfer is not served half old, half new
+    """
+
+    def __init__(self, maxHandles: int = 256, maxBytes: int = 64 * 1024 * 1024):
+        self.pageSize = 64 * 1024
+        self.maxHandles = maxHandles
+        self.maxPages = max(1, maxBytes // self.pageSize)
+
+        # filename -> open file entry of its current version, least recently used first
+        self.handles = collections.OrderedDict()
+        # (file version, page index) -> bytes, least recently used first
+        self.pages = collections.OrderedDict()
+
+        self.hits, self.misses = 0, 0
+
+    def acquire(self, filename: str) -> dict:
+        """Opens a file, or reuses its open handle, and pins it for a session"""
+        path = f"{SERVER_FOLDER}/{filename}"
+
+        # the file may have been replaced or rewritten in place since it was
+        # opened, by anything other than a WRQ, e.g. an operator updating it
+        if filename in self.handles:
+            try:
+                version = fileVersion(os.stat(path))
+            except OSError:
+                version = None
+
+            if version != self.handles[filename]["version"]:
+                self.invalidate(filename)
+
+        if filename in self.handles:
+            self.handles.move_to_end(filename)
+            entry = self.handles[filename]
+        else:
+            handle = open(path, "rb")
+            stat = os.fstat(handle.fileno())
+
+            entry = {
+                "filename": filename,
+                "handle": handle,
+                # a changed file has a new version, so its pages never mix
+                "version": fileVersion(stat),
+                "size": stat.st_size,
+                "refs": 0,
+            }
+            self.handles[filename] = entry
+
+        entry["refs"] += 1
+        self.evict()
+
+        return entry
+
+    def release(self, entry: dict) -> None:
+        """Unpins a file once a session is done with it"""
+        entry["refs"] -= 1
+
+        # a handle to a version that was since replaced is closed once unused
+        if entry["refs"] == 0 and self.handles.get(entry["filename"]) is not entry:
+            entry["handle"].close()
+        else:
+            self.evict()
+
+    def evict(self) -> None:
+        """Closes least recently used handles that no session is reading from"""
+        for filename in list(self.handles):
+            if len(self.handles) <= self.maxHandles:
+                break
+
+            if self.handles[filename]["refs"] == 0:
+                self.handles.pop(filename)["handle"].close()
+
+    def getPage(self, entry: dict, pageIndex: int) -> bytes:
+        key = (entry["version"], pageIndex)
+
+        if key in self.pages:
+            self.hits += 1
+            self.pages.move_to_end(key)
+            return self.pages[key]
+
+        self.misses += 1
+
+        entry["handle"].seek(pageIndex * self.pageSize)
+        page = entry["handle"].read(self.pageSize)
+
+        self.pages[key] = page
+        if len(self.pages) > self.maxPages:
+            self.pages.popitem(last=False)
+
+        return page
+
+    def read(self, entry: dict, offset: int, numBytes: int) -> bytes:
+        """Reads numBytes at offset, a block may span several pages"""
+        chunks = []
+
+        while numBytes > 0:
+            pageIndex, pageOffset = divmod(offset, self.pageSize)
+            page = self.getPage(entry, pageIndex)
+
+            chunk = page[pageOffset : pageOffset + numBytes]
+            if not chunk:
+                # end of file
+                break
+
+            chunks.append(chunk)
+            offset += len(chunk)
+            numBytes -= len(chunk)
+
+        return b"".join(chunks)
+
+    def invalidate(self, filename: str) -> None:
+        """
+        Makes new sessions open a file that was just replaced, sessions
+        still reading the old version keep it until they are done
+        """
+        entry = self.handles.pop(filename, None)
+
+        if entry != None and entry["refs"] == 0:
+            entry["handle"].close()
+
+    def close(self) -> None:
+        for entry in self.handles.values():
+            entry["handle"].close()
+
+        self.handles.clear()
+        self.pages.clear()
+
+
+class Session:
+    """A single RRQ or WRQ transfer with its own TID"""
+
+    def __init__(self, client: tuple, mode: str, filename: str, blksize: int):
+        self.client = client
+        self.mode = mode
+        self.filename = filename
+        self.blksize = blksize
+
+        # RRQ: block last sent, WRQ: block last ACKed
+        self.block = 0
+        # set once the final (short) block is sent or received
+        self.finished = False
+
+        # last packet sent, kept for retransmission
+        self.lastPacket = None
+        self.deadline = 0
+        self.numTimeouts = 0
+
+        # RRQ sessions read from a pinned cache entry
+        self.entry = None
+
+        # WRQ sessions write to their own partial file, moved in place on completion
+        self.file = None
+        self.partPath = None
+
+        # "A requesting host chooses its source TID as described above",
+        # so does the server for every transfer
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+
+class Server:
+    def __init__(self, bindIP: str = "", port: int = 69, reusePort: bool = False):
+        self.bindIP = bindIP
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reusePort:
+            # worker processes share the request port, the kernel
+            # spreads incoming requests between them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # a burst of requests from a fleet booting at once should
+        # not overflow the default receive buffer
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, REQUEST_BUFFER)
+        self.sock.bind((bindIP, port))
+        self.sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+        self.cache = FileCache()
+
+        # uploads get the permissions of any newly created file,
+        # rather than the owner-only ones of a temporary file
+        umask = os.umask(0)
+        os.umask(umask)
+        self.fileMode = 0o666 & ~umask
+
+        # (deadline, sequence number, session), stale entries are skipped
+        self.timers = []
+        self.timerCount = itertools.count()
+
+        self.sessions = {}
+        self.peakSessions, self.numCompleted, self.numFailed = 0, 0, 0
+
+        # same throughput metrics as the client, over all sessions
+        self.pacer = tftp_pacer.Pacer()
+        self.lastReport = time.monotonic()
+
+        print(f"[{os.getpid()}] Listening on {bindIP or "0.0.0.0"}:{port}")
+
+    def close(self):
+        for session in list(self.sessions.values()):
+            self.endSession(session, False)
+
+        self.selector.close()
+        self.sock.close()
+        self.cache.close()
+
+    def loop(self):
+        """Main loop for the server"""
+        while True:
+            timeout = TIMEOUT
+            if len(self.timers) > 0:
+                timeout = max(0, min(timeout, self.timers[0][0] - time.monotonic()))
+
+            for key, _ in self.selector.select(timeout):
+                if key.data == None:
+                    self.receiveRequests()
+                    continue
+
+                # a session gone wrong must not take the others down with it
+                try:
+                    self.receivePackets(key.data)
+                except Exception as err:
+                    print(f"[{type(err).__name__}]: {err}")
+
+                    if id(key.data) in self.sessions:
+                        self.endSession(key.data, False)
+
+            self.checkTimeouts()
+
+            if time.monotonic() - self.lastReport >= REPORT_INTERVAL:
+                self.report()
+
+    def report(self) -> None:
+        """Prints throughput and session counts"""
+        self.lastReport = time.monotonic()
+
+        print(
+            f"[{os.getpid()}] Sessions: {len(self.sessions)} active, "
+            + f"{self.peakSessions} peak, {self.numCompleted} completed, "
+            + f"{self.numFailed} failed; Cache: {self.cache.hits} hits, "
+            + f"{self.cache.misses} misses"
+        )
+        print(f"[{os.getpid()}] {self.pacer.report()}")
+
+    def receiveRequests(self) -> None:
+        """Drains the request port, each request starts a session"""
+        while True:
+            try:
+                data, client = self.sock.recvfrom(65536)
+            except (BlockingIOError, ConnectionResetError):
+                return
+
+            try:
+                self.startSession(tftp_packets.parseData(data), client)
+            except Exception as err:
+                print(f"[{type(err).__name__}]: {err}")
+                self.sock.sendto(tftp_packets.makeError(4), client)
+
+    def startSession(self, request: dict, client: tuple) -> None:
+        if request["opcode"] not in [1, 2]:
+            self.sock.sendto(tftp_packets.makeError(4), client)
+            return
+
+        mode = tftp_packets.OPCODES[request["opcode"]]
+        filename = request["filename"]
+
+        if request["mode"] != "octet":
+            self.sock.sendto(
+                tftp_packets.makeError(0, "Only octet mode is supported"), client
+            )
+            return
+
+        # do not let clients escape the server folder
+        if os.path.basename(filename) != filename or filename in ["", ".", ".."]:
+            self.sock.sendto(tftp_packets.makeError(2), client)
+            return
+
+        path = f"{SERVER_FOLDER}/{filename}"
+
+        # only regular files are served, not directories or devices
+        if mode == "RRQ" and not os.path.isfile(path):
+            self.sock.sendto(tftp_packets.makeError(1), client)
+            return
+
+        if mode == "WRQ" and os.path.exists(path) and not os.path.isfile(path):
+            self.sock.sendto(tftp_packets.makeError(2), client)
+            return
+
+        # See RFC 2347, options the server does not support are left out of the OACK
+        options = {}
+        blksize = 512
+
+        if "blksize" in request["options"]:
+            blksize = max(8, min(request["options"]["blksize"], MAX_BLKSIZE))
+            options["blksize"] = blksize
+
+        session = Session(client, mode, filename, blksize)
+
+        # Everything that may fail happens before the session is registered
+        try:
+            session.sock.bind((self.bindIP, 0))
+
+            if mode == "RRQ":
+                session.entry = self.cache.acquire(filename)
+            else:
+                # each upload gets its own partial file, so two uploads
+                # of the same name do not write into one file
+                fd, session.partPath = tempfile.mkstemp(
+                    prefix=f".{filename}.", suffix=".part", dir=SERVER_FOLDER
+                )
+                session.file = os.fdopen(fd, "wb")
+
+                if hasattr(os, "fchmod"):
+                    os.fchmod(fd, self.fileMode)
+        except OSError as err:
+            print(f"[{type(err).__name__}]: {err}")
+            self.closeSession(session)
+
+            if mode == "WRQ":
+                errcode = 3
+            else:
+                errcode = 1 if isinstance(err, FileNotFoundError) else 2
+
+            self.sock.sendto(tftp_packets.makeError(errcode), client)
+            return
+
+        if "tsize" in request["options"]:
+            if mode == "RRQ":
+                # See RFC 2349, the size of the file is returned in the OACK
+                options["tsize"] = session.entry["size"]
+            else:
+                options["tsize"] = request["options"]["tsize"]
+
+        self.sessions[id(session)] = session
+        self.selector.register(session.sock, selectors.EVENT_READ, session)
+        self.peakSessions = max(self.peakSessions, len(self.sessions))
+
+        try:
+            if len(options) > 0:
+                # the client ACKs the OACK with block 0 on RRQ, or
+                # starts sending DATA on WRQ
+                self.sendPacket(session, tftp_packets.makeOack(options))
+            elif mode == "RRQ":
+                self.sendNextBlock(session)
+            else:
+                self.sendPacket(session, tftp_packets.makeAck(0))
+        except Exception:
+            # the caller answers with an error, the session must not linger
+            if id(session) in self.sessions:
+                self.endSession(session, False)
+            raise
+
+    def receivePackets(self, session: Session) -> None:
+        """Drains the session socket"""
+        while id(session) in self.sessions:
+            try:
+                data, client = session.sock.recvfrom(session.blksize + 4)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                self.endSession(session, False)
+                return
+
+            if client != session.client:
+                # "If a source TID does not match, the packet should be
+                # discarded as erroneously sent from somewhere else."
+                session.sock.sendto(tftp_packets.makeError(5), client)
+                continue
+
+            packet = tftp_packets.parseData(data)
+
+            match packet["opcode"]:
+                case 3 if session.mode == "WRQ":
+                    self.receiveBlock(session, packet)
+                case 4 if session.mode == "RRQ":
+                    # Skip duplicate ACKs, only the block last sent moves things along
+                    if packet["block"] != session.block % 65536:
+                        continue
+
+                    if session.finished:
+                        self.endSession(session, True)
+                    else:
+                        self.sendNextBlock(session)
+                case 5:
+                    self.endSession(session, False)
+                case _:
+                    session.sock.sendto(tftp_packets.makeError(4), client)
+                    self.endSession(session, False)
+
+    def sendNextBlock(self, session: Session) -> None:
+        session.block += 1
+
+        try:
+            data = self.cache.read(
+                session.entry, (session.block - 1) * session.blksize, session.blksize
+            )
+        except OSError as err:
+            # only this session ends, e.g. the file became unreadable
+            print(f"[{type(err).__name__}]: {err}")
+            errcode = 1 if isinstance(err, FileNotFoundError) else 2
+            session.sock.sendto(tftp_packets.makeError(errcode), session.client)
+            self.endSession(session, False)
+            return
+
+        # See RFC 1350, sec. 6, a block shorter than blksize ends the transfer
+        session.finished = len(data) < session.blksize
+
+        self.pacer.count(len(data))
+        self.sendPacket(session, tftp_packets.makeData(session.block, data))
+
+    def receiveBlock(self, session: Session, packet: dict) -> None:
+        if packet["block"] == session.block % 65536:
+            # our ACK was lost, ACK again
+            self.sendPacket(session, tftp_packets.makeAck(session.block))
+            return
+
+        if packet["block"] != (session.block + 1) % 65536:
+            return
+
+        try:
+            session.file.write(packet["data"])
+        except OSError as err:
+            print(f"[{type(err).__name__}]: {err}")
+            session.sock.sendto(tftp_packets.makeError(3), session.client)
+            self.endSession(session, False)
+            return
+
+        session.block += 1
+        self.pacer.count(len(packet["data"]))
+
+        self.sendPacket(session, tftp_packets.makeAck(session.block))
+
+        if len(packet["data"]) < session.blksize:
+            self.endSession(session, True)
+
+    def sendPacket(self, session: Session, packet: bytes) -> None:
+        session.lastPacket = packet
+        session.numTimeouts = 0
+
+        session.sock.sendto(packet, session.client)
+        self.setTimer(session)
+
+    def setTimer(self, session: Session) -> None:
+        session.deadline = time.monotonic() + TIMEOUT
+        heapq.heappush(self.timers, (session.deadline, next(self.timerCount), session))
+
+    def checkTimeouts(self) -> None:
+        """Retransmits the last packet of sessions that timed out"""
+        now = time.monotonic()
+
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            deadline, _, session = heapq.heappop(self.timers)
+
+            # skip timers of finished sessions or ones pushed back since
+            if id(session) not in self.sessions or session.deadline != deadline:
+                continue
+
+            if session.numTimeouts >= MAX_RETRIES:
+                self.endSession(session, False)
+                continue
+
+            session.numTimeouts += 1
+            session.sock.sendto(session.lastPacket, session.client)
+            self.setTimer(session)
+
+    def endSession(self, session: Session, success: bool) -> None:
+        del self.sessions[id(session)]
+        self.selector.unregister(session.sock)
+
+        if session.file != None and success:
+            session.file.close()
+
+            try:
+                os.replace(session.partPath, f"{SERVER_FOLDER}/{session.filename}")
+                self.cache.invalidate(session.filename)
+            except OSError as err:
+                print(f"[{type(err).__name__}]: {err}")
+                success = False
+
+        self.closeSession(session)
+
+        if success:
+            self.numCompleted += 1
+        else:
+            self.numFailed += 1
+
+    def closeSession(self, session: Session) -> None:
+        """Releases what a session holds, its partial file is removed if still there"""
+        session.sock.close()
+
+        if session.entry != None:
+            self.cache.release(session.entry)
+            session.entry = None
+
+        if session.file != None:
+            session.file.close()
+
+            try:
+                os.remove(session.partPath)
+            except FileNotFoundError:
+                # already moved in place
+                pass
+
+
+def raiseFileLimit() -> None:
+    """Every session holds a socket, so allow as many as the system permits"""
+    if resource == None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def runServer(bindIP: str, port: int, reusePort: bool) -> None:
+    raiseFileLimit()
+    server = Server(bindIP, port, reusePort)
+
+    try:
+        server.loop()
+    except KeyboardInterrupt:
+        server.report()
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    bindIP, port, numWorkers = "", 69, 1
+
+    args = sys.argv[1:]
+    for i in range(0, len(args) - 1, 2):
+        match args[i]:
+            case "-bind":
+                bindIP = args[i + 1]
+            case "-port":
+                port = int(args[i + 1])
+            case "-workers":
+                numWorkers = max(1, int(args[i + 1]))
+
+    tftp_files.makeFolder(SERVER_FOLDER)
+
+    if numWorkers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("Worker processes are not supported on this platform\n")
+        numWorkers = 1
+
+    if numWorkers == 1:
+        runServer(bindIP, port, False)
+    else:
+        workers = [
+            multiprocessing.Process(target=runServer, args=(bindIP, port, True))
+            for _ in range(numWorkers)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            print("\nExiting...\n")